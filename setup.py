@@ -10,10 +10,14 @@ setup(
     classifiers=["Programming Language :: Python :: 3 :: Only"],
     py_modules=["target_postgres"],
     install_requires=[
-        "singer-python==5.1.1",
+        "fastjsonschema>=2.19",
         "psycopg2-binary",
         "inflection==0.3.1"
     ],
+    extras_require={
+        "orjson": ["orjson"],
+        "test": ["pytest"]
+    },
     entry_points="""
     [console_scripts]
     target-postgres=target_postgres:main
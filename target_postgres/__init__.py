@@ -1,26 +1,229 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
+import gc
 import io
 import math
+import multiprocessing
+import operator
 import os
+import re
 import sys
 import json
+import logging
 import threading
-import http.client
-import urllib
-from datetime import datetime
-import collections
-from tempfile import NamedTemporaryFile
-
-import pkg_resources
-from jsonschema import Draft4Validator, FormatChecker
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import fastjsonschema
 import decimal
 from decimal import Decimal
-import singer
-from target_postgres.db_sync import DbSync
+from target_postgres.db_sync import DbSync, BINARY_COPY_HEADER, BINARY_COPY_TRAILER, CSV_NULL
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1 << 20
+# Batch load throughput in Postgres has been measured to plateau at about
+# 10k rows per batch and to regress with much larger batches.
+DEFAULT_BATCH_SIZE = 10000
+# Upper bound of auto_tune_batch, larger batches mean larger temp tables and longer merges
+DEFAULT_MAX_BATCH_SIZE = 1000000
+# Every open batch holds a connection with a COPY in progress, flushing the
+# oldest one beyond this keeps interleaved streams below max_connections
+DEFAULT_MAX_OPEN_BATCHES = 16
+MAX_TABLE_SYNC_WORKERS = 8
+WORKER_BATCH_LINES = 1000
+WORKER_QUEUE_SIZE = 16
+# Integer literals orjson may not parse exactly, it turns integers beyond 64 bits into floats
+LONG_DIGITS = re.compile(r'\d{19}')
+LONG_DIGITS_BYTES = re.compile(rb'\d{19}')
+# Singer schemas are draft 4, fastjsonschema assumes the latest draft when $schema is missing
+DRAFT_04_SCHEMA = 'http://json-schema.org/draft-04/schema#'
+# Start of the RECORD and SCHEMA messages written by singer-python, used to
+# route them to workers without parsing them
+STREAM_MESSAGE_PREFIX = re.compile(rb'\{\s*"type"\s*:\s*"(RECORD|SCHEMA)"\s*,\s*"stream"\s*:\s*"([^"\\]*)"')
+
+
+def json_loads(line):
+    '''Parse a JSON line with orjson when it is installed, falling back to
+    json for lines orjson rejects (NaN, Infinity, 1e400) and for lines with
+    integers orjson would round.'''
+    if orjson is not None:
+        long_digits = LONG_DIGITS_BYTES if isinstance(line, bytes) else LONG_DIGITS
+        if long_digits.search(line) is None:
+            try:
+                return orjson.loads(line)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(line)
+
+
+class StreamLoader(threading.Thread):
+    '''Load one batch of a stream's records into Postgres.
+
+    Rows are written in the stream's COPY format into an OS pipe whose
+    reading end is consumed by a COPY running on this thread, so batches
+    stream straight into Postgres instead of being staged on disk first.
+
+    Once closed, a batch finishes loading in the background while the next
+    one is being written. The next batch copies into its own temp table
+    concurrently but only merges it into the target table after `previous`
+    has been loaded, so upserts keep the order of the input.'''
+
+    def __init__(self, sync, previous=None):
+        super().__init__(daemon=True)
+        read_fd, write_fd = os.pipe()
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            # Let a full write buffer go into the pipe in one write
+            try:
+                fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, COPY_BUFFER_SIZE)
+            except OSError:
+                pass
+        self.sync = sync
+        self.previous = previous
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.binary = sync.copy_format == 'binary'
+        if self.binary:
+            self.writer = os.fdopen(write_fd, 'wb', buffering=COPY_BUFFER_SIZE)
+            self.writer.write(BINARY_COPY_HEADER)
+            self.write_row = self.writer.write
+        else:
+            # Without write_through, rows are encoded and handed to the buffer a few KiB at a time
+            self.writer = io.TextIOWrapper(os.fdopen(write_fd, 'wb', buffering=COPY_BUFFER_SIZE),
+                                           encoding='utf-8', newline='')
+            self.csv_writer = csv.writer(self.writer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+            if len(sync.flatten_schema) == 1:
+                self.write_row = self.write_single_column_row
+            else:
+                self.write_row = self.csv_writer.writerow
+        self.row_count = 0
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            with self.reader:
+                self.sync.load_csv(self.reader, before_merge=self.wait_for_previous)
+        except Exception as err:
+            self.error = err
+
+    def wait_for_previous(self):
+        previous = self.previous
+        if previous is not None:
+            previous.join()
+            if previous.error is not None:
+                raise previous.error
+            self.previous = None
+
+    def write_single_column_row(self, row):
+        if row[0] is CSV_NULL:
+            # csv.writer quotes a row made of a single empty field, which COPY reads as ''
+            self.writer.write('\n')
+        else:
+            self.csv_writer.writerow(row)
+
+    def write(self, row):
+        try:
+            self.write_row(row)
+        except BrokenPipeError:
+            # COPY stopped reading, report the reason instead of the broken pipe
+            self.finish()
+            raise
+        self.row_count += 1
+
+    def close(self):
+        '''Signal the end of the batch without waiting for it to be loaded.'''
+        if self.writer.closed:
+            return
+        # A broken pipe means COPY stopped reading, finish reports why
+        if self.binary:
+            try:
+                self.writer.write(BINARY_COPY_TRAILER)
+            except BrokenPipeError:
+                pass
+        try:
+            self.writer.close()
+        except BrokenPipeError:
+            pass
+
+    def finish(self):
+        '''Signal the end of the batch and wait for it, and the batches
+        before it, to be loaded.'''
+        self.close()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+class BatchSizeTuner:
+    '''Keep doubling the batch size of a stream, up to `max_batch_size`, for as
+    long as the doubled batches load more than 10% more rows per second than the
+    previous size.
+
+    Throughput is measured between two consecutive flushes, which includes both
+    writing the batch and waiting for the merge of the batch before it.'''
+
+    def __init__(self, batch_size, max_batch_size, enabled):
+        self.batch_size = min(batch_size, max_batch_size) if enabled else batch_size
+        self.max_batch_size = max_batch_size
+        self.tuning = enabled and batch_size < max_batch_size
+        self.rows_per_second = None
+        self.last_flush = None
+
+    def flushed(self, row_count):
+        now = time.monotonic()
+        # Batches cut short by a duplicate key or a new schema don't tell anything about the batch size
+        if self.tuning and self.last_flush is not None and row_count >= self.batch_size:
+            self.observe(row_count, now - self.last_flush)
+        self.last_flush = now
+
+    def observe(self, row_count, seconds):
+        if seconds <= 0:
+            return
+        rows_per_second = row_count / seconds
+        if self.rows_per_second is not None and rows_per_second <= self.rows_per_second * 1.1:
+            # Not worth it, go back to the previous size and stick to it
+            self.batch_size //= 2
+            self.tuning = False
+            logger.info('Settled on batch size {}'.format(self.batch_size))
+        else:
+            self.rows_per_second = rows_per_second
+            self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+            if self.batch_size == self.max_batch_size:
+                self.tuning = False
+                logger.info('Settled on maximum batch size {}'.format(self.batch_size))
+
+
+class StreamState:
+    '''What persist_lines keeps track of for a stream. `loader` is the batch
+    being written, `loading` the last closed one.'''
+
+    __slots__ = ('schema', 'validator', 'primary_key', 'primary_keys_seen',
+                 'sync', 'table_sync', 'loader', 'loading', 'batch_size_tuner')
+
+    def __init__(self, batch_size_tuner):
+        self.schema = None
+        self.validator = None
+        self.primary_key = None
+        self.primary_keys_seen = set()
+        self.sync = None
+        self.table_sync = None
+        self.loader = None
+        self.loading = None
+        self.batch_size_tuner = batch_size_tuner
 
-logger = singer.get_logger()
 
 def float_to_decimal(value):
     '''Walk the given data structure and turn all instances of float into
@@ -33,6 +236,7 @@ def float_to_decimal(value):
         return {k: float_to_decimal(v) for k, v in value.items()}
     return value
 
+
 def numeric_schema_with_precision(schema):
     if 'type' not in schema:
         return False
@@ -68,6 +272,47 @@ def walk_schema_for_numeric_precision(schema):
                 walk_schema_for_numeric_precision(v)
 
 
+def compile_validator(schema):
+    '''Return a function validating records against the Singer `schema`.'''
+    if '$schema' not in schema:
+        # Draft 4 reads "exclusiveMaximum": true as a flag, later drafts as the bound 1
+        schema = dict(schema, **{'$schema': DRAFT_04_SCHEMA})
+    # fastjsonschema checks multipleOf on floats with Decimal arithmetic by itself.
+    # Formats aren't checked, like jsonschema's FormatChecker without its optional
+    # dependencies did, so that timestamps without an offset are still accepted.
+    return fastjsonschema.compile(schema, use_default=False, use_formats=False)
+
+
+def iter_lines(file, chunk_size=1 << 20):
+    '''Yield the lines of a binary file as bytes, without line endings.'''
+    # Pieces of the current line, joined once its end is found
+    pending = []
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        if b'\n' not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split(b'\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+        tail = lines.pop()
+        pending = [tail] if tail else []
+        yield from lines
+    if pending:
+        yield b''.join(pending)
+
+
+def primary_key_getter(key_properties):
+    '''Return a function giving the primary key of a record as a hashable
+    value, or None for streams without key properties.'''
+    if not key_properties:
+        return lambda record: None
+    return operator.itemgetter(*key_properties)
+
+
 def emit_state(state):
     if state is not None:
         line = json.dumps(state)
@@ -76,107 +321,275 @@ def emit_state(state):
         sys.stdout.flush()
 
 
+class Context:
+    '''What the message handlers of persist_lines share.'''
+
+    __slots__ = ('config', 'state', 'streams', 'open_batches', 'schema_created', 'executor',
+                 'batch_size', 'max_batch_size', 'max_open_batches', 'auto_tune_batch', 'validate_records')
+
+    def __init__(self, config):
+        self.config = config
+        self.state = None
+        self.streams = {}
+        # Streams by when their batch was opened, flushed ones are only dropped in limit_open_batches
+        self.open_batches = {}
+        self.schema_created = False
+        self.executor = ThreadPoolExecutor(max_workers=MAX_TABLE_SYNC_WORKERS)
+        self.batch_size = config.get('batch_size', DEFAULT_BATCH_SIZE)
+        self.max_batch_size = config.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE)
+        self.max_open_batches = config.get('max_open_batches', DEFAULT_MAX_OPEN_BATCHES)
+        self.auto_tune_batch = config.get('auto_tune_batch', False)
+        self.validate_records = config.get('validate_records', True)
+
+
+def handle_record(context, o):
+    if o['stream'] not in context.streams:
+        raise Exception(
+            "A record for stream {} was encountered before a corresponding schema".format(o['stream']))
+
+    # Get schema for this record's stream
+    stream = context.streams[o['stream']]
+    record = o['record']
+
+    # Validate record
+    if stream.validator is not None:
+        stream.validator(record)
+
+    primary_key = stream.primary_key(record)
+    if primary_key is not None and primary_key in stream.primary_keys_seen:
+        flush_records(stream)
+
+    if stream.loader is None:
+        if stream.table_sync is not None:
+            stream.table_sync.result()
+            stream.table_sync = None
+        limit_open_batches(context)
+        stream.loader = StreamLoader(stream.sync, stream.loading)
+        stream.loading = None
+        context.open_batches[o['stream']] = stream
+    stream.loader.write(stream.sync.record_to_copy_row(record))
+    if primary_key is not None:
+        stream.primary_keys_seen.add(primary_key)
+
+    if stream.loader.row_count >= stream.batch_size_tuner.batch_size:
+        flush_records(stream)
+
+    context.state = None
+
+
+def limit_open_batches(context):
+    '''Flush the batch opened first when `max_open_batches` batches are open,
+    to make room for a new one.'''
+    open_batches = context.open_batches
+    for stream_name, stream in list(open_batches.items()):
+        if stream.loader is None:
+            del open_batches[stream_name]
+    if len(open_batches) >= context.max_open_batches:
+        stream_name = next(iter(open_batches))
+        flush_records(open_batches.pop(stream_name))
+
+
+def handle_state(context, o):
+    logger.debug('Setting state to {}'.format(o['value']))
+    context.state = o['value']
+
+
+def handle_schema(context, o):
+    stream_name = o['stream']
+    schema = float_to_decimal(o['schema'])
+    if 'properties' not in schema:
+        logger.debug(f"Schema for stream '{stream_name}' misses properties. Waiting for properly-formed schema.")
+        return
+    if stream_name not in context.streams:
+        context.streams[stream_name] = StreamState(
+            BatchSizeTuner(context.batch_size, context.max_batch_size, context.auto_tune_batch))
+    stream = context.streams[stream_name]
+    stream.schema = o
+    if context.validate_records:
+        walk_schema_for_numeric_precision(schema)
+        stream.validator = compile_validator(o['schema'])
+    else:
+        stream.validator = None
+    if 'key_properties' not in o:
+        raise Exception("key_properties field is required")
+    stream.primary_key = primary_key_getter(o['key_properties'])
+    if stream.loader is not None:
+        # Rows streamed so far belong to the previous version of the schema
+        flush_records(stream)
+    if stream.loading is not None:
+        stream.loading.finish()
+        stream.loading = None
+    if stream.table_sync is not None:
+        stream.table_sync.result()
+    stream.sync = DbSync(context.config, o)
+    if not context.schema_created:
+        stream.sync.create_schema_if_not_exists()
+        context.schema_created = True
+    # Sync tables in the background, a stream only waits for its table on its first record
+    stream.table_sync = context.executor.submit(stream.sync.sync_table)
+
+
+def handle_activate_version(context, o):
+    logger.debug('ACTIVATE_VERSION message')
+
+
+MESSAGE_HANDLERS = {
+    'RECORD': handle_record,
+    'STATE': handle_state,
+    'SCHEMA': handle_schema,
+    'ACTIVATE_VERSION': handle_activate_version,
+}
+
+
+def parse_message(line):
+    '''Parse a line into a message, returning it with its type and, for RECORD
+    and SCHEMA messages, its stream.'''
+    try:
+        o = json_loads(line)
+    except json.decoder.JSONDecodeError:
+        logger.error("Unable to parse:\n{}".format(line))
+        raise
+
+    if 'type' not in o:
+        raise Exception("Line is missing required key 'type': {}".format(line))
+    t = o['type']
+    if t not in MESSAGE_HANDLERS:
+        raise Exception("Unknown message type {} in message {}"
+                        .format(o['type'], o))
+
+    stream = None
+    if t == 'RECORD' or t == 'SCHEMA':
+        if 'stream' not in o:
+            raise Exception("Line is missing required key 'stream': {}".format(line))
+        stream = o['stream']
+    return o, t, stream
+
+
 def persist_lines(config, lines):
-    state = None
-    schemas = {}
-    key_properties = {}
-    headers = {}
-    validators = {}
-    csv_files_to_load = {}
-    row_count = {}
-    stream_to_sync = {}
-    primary_key_exists = {}
-    batch_size = config['batch_size'] if 'batch_size' in config else 100000
-
-    now = datetime.now().strftime('%Y%m%dT%H%M%S')
-
-    # Loop over lines from stdin
-    for line in lines:
+    context = Context(config)
+
+    # Records allocate plenty of short-lived objects but hardly any cycles,
+    # collect garbage once per batch instead of all along
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # Loop over lines from stdin
+        for line in lines:
+            o, t, _ = parse_message(line)
+            MESSAGE_HANDLERS[t](context, o)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    for stream in context.streams.values():
+        if stream.loader is not None:
+            flush_records(stream)
+    for stream in context.streams.values():
+        if stream.loading is not None:
+            stream.loading.finish()
+        if stream.table_sync is not None:
+            stream.table_sync.result()
+    context.executor.shutdown()
+
+    return context.state
+
+
+def flush_records(stream):
+    loader = stream.loader
+    loader.close()
+    # Keep at most two batches per stream in flight
+    previous = loader.previous
+    if previous is not None:
+        previous.finish()
+    stream.batch_size_tuner.flushed(loader.row_count)
+    stream.loader = None
+    stream.loading = loader
+    stream.primary_keys_seen = set()
+    gc.collect()
+
+
+def iter_queue(queue):
+    '''Yield the lines of the batches put on `queue` until None is received.'''
+    while True:
+        lines = queue.get()
+        if lines is None:
+            return
+        yield from lines
+
+
+def configure_logging():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(levelname)s %(message)s')
+
+
+def persist_worker_lines(config, queue):
+    configure_logging()
+    persist_lines(config, iter_queue(queue))
+
+
+def put_lines(queue, worker, lines):
+    while True:
         try:
-            o = json.loads(line)
-        except json.decoder.JSONDecodeError:
-            logger.error("Unable to parse:\n{}".format(line))
-            raise
+            queue.put(lines, timeout=1)
+            return
+        except Full:
+            if not worker.is_alive():
+                raise Exception("Worker {} exited with code {}".format(worker.name, worker.exitcode))
+
+
+def persist_lines_in_workers(config, lines, workers):
+    '''Spread the streams over `workers` processes, each running persist_lines
+    on the messages of its own streams. Messages are routed by stream here,
+    parsing only the lines that don't start like a RECORD or SCHEMA message.'''
+    queues = [multiprocessing.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=persist_worker_lines, args=(config, queue), daemon=True)
+        for queue in queues
+    ]
+    for process in processes:
+        process.start()
 
-        if 'type' not in o:
-            raise Exception("Line is missing required key 'type': {}".format(line))
-        t = o['type']
+    state = None
+    routes = {}
+    batches = [[] for _ in range(workers)]
+    for line in lines:
+        match = STREAM_MESSAGE_PREFIX.match(line)
+        if match:
+            t = match.group(1).decode('ascii')
+            stream = match.group(2).decode('utf-8')
+        else:
+            o, t, stream = parse_message(line)
+            if t == 'STATE':
+                logger.debug('Setting state to {}'.format(o['value']))
+                state = o['value']
+                continue
+            elif t == 'ACTIVATE_VERSION':
+                logger.debug('ACTIVATE_VERSION message')
+                continue
 
         if t == 'RECORD':
-            if 'stream' not in o:
-                raise Exception("Line is missing required key 'stream': {}".format(line))
-            if o['stream'] not in schemas:
-                raise Exception(
-                    "A record for stream {} was encountered before a corresponding schema".format(o['stream']))
-
-            # Get schema for this record's stream
-            stream = o['stream']
-
-            # Validate record
-            validators[stream].validate(float_to_decimal(o['record']))
-
-            sync = stream_to_sync[stream]
-
-            primary_key_string = sync.record_primary_key_string(o['record'])
-            if stream not in primary_key_exists:
-                primary_key_exists[stream] = {}
-            if primary_key_string and primary_key_string in primary_key_exists[stream]:
-                flush_records(o, csv_files_to_load, row_count, primary_key_exists, sync)
-
-            csv_line = sync.record_to_csv_line(o['record'])
-            csv_files_to_load[o['stream']].write(bytes(csv_line + '\n', 'UTF-8'))
-            row_count[o['stream']] += 1
-            if primary_key_string:
-                primary_key_exists[stream][primary_key_string] = True
-
-            if row_count[o['stream']] >= batch_size:
-                flush_records(o, csv_files_to_load, row_count, primary_key_exists, sync)
-
             state = None
-        elif t == 'STATE':
-            logger.debug('Setting state to {}'.format(o['value']))
-            state = o['value']
-        elif t == 'SCHEMA':
-            if 'stream' not in o:
-                raise Exception("Line is missing required key 'stream': {}".format(line))
-            stream = o['stream']
-            schema = float_to_decimal(o['schema'])
-            if 'properties' not in schema:
-                logger.debug(f"Schema for stream '{stream}' misses properties. Waiting for properly-formed schema.")
-                continue
-            schemas[stream] = o
-            walk_schema_for_numeric_precision(schema)
-            validators[stream] = Draft4Validator(schema, format_checker=FormatChecker())
-            if 'key_properties' not in o:
-                raise Exception("key_properties field is required")
-            key_properties[stream] = o['key_properties']
-            stream_to_sync[stream] = DbSync(config, o)
-            stream_to_sync[stream].create_schema_if_not_exists()
-            stream_to_sync[stream].sync_table()
-            row_count[stream] = 0
-            csv_files_to_load[stream] = NamedTemporaryFile(mode='w+b')
-        elif t == 'ACTIVATE_VERSION':
-            logger.debug('ACTIVATE_VERSION message')
-        else:
-            raise Exception("Unknown message type {} in message {}"
-                            .format(o['type'], o))
-
-    for (stream_name, count) in row_count.items():
-        if count > 0:
-            stream_to_sync[stream_name].load_csv(csv_files_to_load[stream_name], count)
+        if stream not in routes:
+            routes[stream] = len(routes) % workers
+        worker = routes[stream]
+        batches[worker].append(line)
+        if len(batches[worker]) >= WORKER_BATCH_LINES:
+            put_lines(queues[worker], processes[worker], batches[worker])
+            batches[worker] = []
+
+    for queue, process, batch in zip(queues, processes, batches):
+        if batch:
+            put_lines(queue, process, batch)
+        put_lines(queue, process, None)
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise Exception("Worker {} exited with code {}".format(process.name, process.exitcode))
 
     return state
 
 
-def flush_records(o, csv_files_to_load, row_count, primary_key_exists, sync):
-    stream = o['stream']
-    sync.load_csv(csv_files_to_load[stream], row_count[stream])
-    row_count[stream] = 0
-    primary_key_exists[stream] = {}
-    csv_files_to_load[stream] = NamedTemporaryFile(mode='w+b')
-
-
 def main():
+    configure_logging()
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Config file')
     args = parser.parse_args()
@@ -187,8 +600,12 @@ def main():
     else:
         config = {}
 
-    input = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    state = persist_lines(config, input)
+    lines = iter_lines(sys.stdin.buffer)
+    workers = config.get('workers', 1)
+    if workers > 1:
+        state = persist_lines_in_workers(config, lines, workers)
+    else:
+        state = persist_lines(config, lines)
 
     emit_state(state)
     logger.debug("Exiting normally")
@@ -1,18 +1,35 @@
 import json
+import logging
 import psycopg2
 import psycopg2.extras
-import singer
-import collections
+import collections.abc
 import inflection
 import re
 import itertools
 import os
 import shutil
+import struct
+from datetime import datetime
+from decimal import Decimal
+from tempfile import SpooledTemporaryFile
 
 TARGET_REJECTED_DIR = os.getenv("TARGET_REJECTED_DIR")
 NULL_TYPE = {'type': 'null'}
+COPY_CHUNK_SIZE = 1 << 16
+DEFAULT_SPOOL_THRESHOLD = 64 << 20
 
-logger = singer.get_logger()
+# Signature, flags and header extension length of the binary COPY format
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('>h', -1)
+BINARY_NULL = struct.pack('>i', -1)
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+NUMERIC_POSITIVE = 0x0000
+NUMERIC_NEGATIVE = 0x4000
+NUMERIC_NAN = 0xC000
+TRUE_STRINGS = {'t', 'true', 'y', 'yes', 'on', '1'}
+FALSE_STRINGS = {'f', 'false', 'n', 'no', 'off', '0'}
+
+logger = logging.getLogger(__name__)
 
 
 def column_type(schema_property):
@@ -99,13 +116,127 @@ def flatten_record(d, parent_key=[], sep='__'):
     items = []
     for k, v in d.items():
         new_key = flatten_key(k, parent_key, sep)
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, collections.abc.MutableMapping):
             items.extend(flatten_record(v, parent_key + [k], sep=sep).items())
         else:
             items.append((new_key, json.dumps(v) if type(v) is list else v))
     return dict(items)
 
 
+def pack_bigint(value):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError('Not an integer: {!r}'.format(value))
+    return struct.pack('>q', int(value))
+
+
+def pack_boolean(value):
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in TRUE_STRINGS:
+            value = True
+        elif text in FALSE_STRINGS:
+            value = False
+    # 1 and 0 compare equal to True and False, like Postgres accepts '1' and '0'
+    if value is True or value == 1:
+        return b'\x01'
+    if value is False or value == 0:
+        return b'\x00'
+    raise ValueError('Not a boolean: {!r}'.format(value))
+
+
+def pack_numeric(value):
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if value.is_nan():
+        return struct.pack('>hhHH', 0, 0, NUMERIC_NAN, 0)
+    sign, digits, exponent = value.as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError('Unsupported numeric value: {}'.format(value))
+
+    # Regroup the decimal digits into base 10000 digits aligned on the decimal point
+    digits = ''.join(map(str, digits))
+    if exponent > 0:
+        digits += '0' * exponent
+    scale = max(-exponent, 0)
+    integer_length = len(digits) - scale
+    left_padding = -integer_length % 4
+    digits = '0' * left_padding + digits
+    digits += '0' * (-len(digits) % 4)
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = (integer_length + left_padding) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+        sign = 0
+
+    return struct.pack('>hhHH{}H'.format(len(groups)),
+                       len(groups), weight, NUMERIC_NEGATIVE if sign else NUMERIC_POSITIVE, scale, *groups)
+
+
+def pack_timestamp(value):
+    if isinstance(value, str):
+        if value.endswith(('Z', 'z')):
+            value = value[:-1] + '+00:00'
+        value = datetime.fromisoformat(value)
+    # Like the text input of timestamp without time zone, ignore the offset
+    delta = value.replace(tzinfo=None) - POSTGRES_EPOCH
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def pack_varchar(value):
+    return str(value).encode('utf-8')
+
+
+def pack_jsonb(value):
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    # jsonb binary format version followed by the JSON text
+    return b'\x01' + value.encode('utf-8')
+
+
+BINARY_PACKERS = {
+    'jsonb': pack_jsonb,
+    'timestamp without time zone': pack_timestamp,
+    'numeric': pack_numeric,
+    'character varying': pack_varchar,
+    'bigint': pack_bigint,
+    'boolean': pack_boolean,
+}
+
+
+class CsvNull:
+    """Written by csv.writer as an unquoted empty field, which COPY reads as NULL.
+
+    QUOTE_NONNUMERIC quotes every field that isn't a number, None included,
+    so the marker poses as one."""
+
+    def __float__(self):
+        return 0.0
+
+    def __str__(self):
+        return ''
+
+
+CSV_NULL = CsvNull()
+
+
+class TeeReader:
+    """File-like reader that copies everything read from `source` into `sink`."""
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sink.write(data)
+        return data
+
+
 def primary_column_names(stream_schema_message):
     return [
         safe_column_name(inflect_column_name(p))
@@ -120,6 +251,15 @@ class DbSync:
         self.stream_schema_message = stream_schema_message
         self.flatten_schema = flatten_schema(stream_schema_message['schema'])
         self.rejected_count = 0
+        self.copy_format = self.connection_config.get('copy_format', 'csv')
+        if self.copy_format == 'binary':
+            self.column_packers = [BINARY_PACKERS[column_type(p)] for p in self.flatten_schema.values()]
+            self.row_header = struct.pack('>h', len(self.column_packers))
+            self.record_to_copy_row = self.record_to_binary_row
+        elif self.copy_format == 'csv':
+            self.record_to_copy_row = self.record_to_csv_row
+        else:
+            raise ValueError('Unsupported copy_format: {}'.format(self.copy_format))
 
     def open_connection(self):
         try:
@@ -170,49 +310,82 @@ class DbSync:
             return
 
         os.makedirs(TARGET_REJECTED_DIR, exist_ok=True)
-        rejected_file_name = "{}-{:04d}.rej.csv".format(self.stream_schema_message['stream'],
-                                                    self.rejected_count)
+        rejected_file_name = "{}-{:04d}.rej.{}".format(self.stream_schema_message['stream'],
+                                                   self.rejected_count,
+                                                   'bin' if self.copy_format == 'binary' else 'csv')
         rejected_file_path = os.path.join(TARGET_REJECTED_DIR,
                                           rejected_file_name)
 
-        shutil.copy(file.name, rejected_file_path)
+        file.seek(0)
+        with open(rejected_file_path, 'wb') as rejected_file:
+            shutil.copyfileobj(file, rejected_file)
         logger.info("Saved rejected entries as {}".format(rejected_file_path))
 
-    def record_primary_key_string(self, record):
-        if len(self.stream_schema_message['key_properties']) == 0:
-            return None
+    def record_to_csv_row(self, record):
+        """Return the column values of `record` in the order of `column_names`,
+        to be written with csv.writer using QUOTE_NONNUMERIC."""
         flatten = flatten_record(record)
-        key_props = [str(flatten[inflect_column_name(p)]) for p in self.stream_schema_message['key_properties']]
-        return ','.join(key_props)
+        return [
+            CSV_NULL if flatten.get(name) is None else flatten[name]
+            for name in self.flatten_schema
+        ]
 
-    def record_to_csv_line(self, record):
+    def record_to_binary_row(self, record):
+        """Return `record` as a tuple of the binary COPY format."""
         flatten = flatten_record(record)
-        return ','.join(
-            [
-                json.dumps(flatten[name]) if name in flatten and flatten[name] is not None else ''
-                for name in self.flatten_schema
-            ]
-        )
-
-    def load_csv(self, file, count):
+        row = [self.row_header]
+        for name, pack in zip(self.flatten_schema, self.column_packers):
+            value = flatten.get(name)
+            if value is None:
+                row.append(BINARY_NULL)
+            else:
+                try:
+                    data = pack(value)
+                except (ValueError, TypeError, ArithmeticError, struct.error) as err:
+                    raise ValueError("Can't write {!r} to column '{}' of stream '{}' in binary COPY format: {}".format(
+                        value, name, self.stream_schema_message['stream'], err)) from err
+                row.append(struct.pack('>i', len(data)))
+                row.append(data)
+        return b''.join(row)
+
+    def load_csv(self, file, before_merge=None):
+        """Load COPY data read from `file` until EOF. `file` may be a pipe,
+        in which case rows are streamed into COPY as they are written.
+
+        `before_merge` is called once the rows are in the temp table, right
+        before they are merged into the target table."""
+        stream_schema_message = self.stream_schema_message
+        stream = stream_schema_message['stream']
+        # A pipe cannot be replayed, so keep a copy of the batch only if rejected batches are saved
+        # Spools to disk only once the batch outgrows spool_threshold
+        rejected = SpooledTemporaryFile(
+            max_size=self.connection_config.get('spool_threshold', DEFAULT_SPOOL_THRESHOLD),
+            mode='w+b'
+        ) if TARGET_REJECTED_DIR else None
+        source = TeeReader(file, rejected) if rejected else file
         try:
-            file.seek(0)
-            stream_schema_message = self.stream_schema_message
-            stream = stream_schema_message['stream']
-            logger.info("Loading {} rows into '{}'".format(count, stream))
+            logger.info("Loading rows into '{}'".format(stream))
 
             with self.open_connection() as connection:
                 with connection.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                    if self.connection_config.get('unsafe_fast_load'):
+                        # Don't wait for the WAL to be flushed on commit
+                        cur.execute("SET LOCAL synchronous_commit TO OFF")
                     cur.execute(self.create_table_query(True))
-                    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT CSV, ESCAPE '\\')".format(
+                    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT {})".format(
                         self.table_name(stream, True),
-                        ', '.join(self.column_names())
+                        ', '.join(self.column_names()),
+                        self.copy_format.upper()
                     )
                     logger.info(copy_sql)
                     cur.copy_expert(
                         copy_sql,
-                        file
+                        source,
+                        size=COPY_CHUNK_SIZE
                     )
+                    logger.info("Loaded {} rows into '{}'".format(cur.rowcount, stream))
+                    if before_merge is not None:
+                        before_merge()
                     if len(self.stream_schema_message['key_properties']) > 0:
                         cur.execute(self.update_from_temp_table())
                         logger.info(cur.statusmessage)
@@ -220,8 +393,14 @@ class DbSync:
                     logger.info(cur.statusmessage)
                     cur.execute(self.drop_temp_table())
         except psycopg2.DataError as err:
-            logger.exception("Failed to load CSV file: {}".format(file.name))
-            self.reject_file(file)
+            logger.exception("Failed to load rows into '{}'".format(stream))
+            # Drain the rest of the batch so that the writing side does not block on a full pipe
+            while source.read(COPY_CHUNK_SIZE):
+                pass
+            self.reject_file(rejected)
+        finally:
+            if rejected:
+                rejected.close()
 
     def insert_from_temp_table(self):
         stream_schema_message = self.stream_schema_message
@@ -308,7 +487,11 @@ class DbSync:
         )
 
         if len(schema_rows) == 0:
-            self.query("CREATE SCHEMA IF NOT EXISTS {}".format(schema_name))
+            try:
+                self.query("CREATE SCHEMA IF NOT EXISTS {}".format(schema_name))
+            except psycopg2.IntegrityError:
+                # Created concurrently by another worker
+                pass
 
     def get_tables(self):
         return self.query(
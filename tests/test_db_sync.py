@@ -0,0 +1,60 @@
+import struct
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from target_postgres.db_sync import pack_bigint, pack_boolean, pack_numeric, pack_timestamp
+
+
+def numeric(ndigits, weight, sign, dscale, *digits):
+    return struct.pack('>hhHH{}H'.format(len(digits)), ndigits, weight, sign, dscale, *digits)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0', numeric(0, 0, 0x0000, 0)),
+    ('0.001', numeric(1, -1, 0x0000, 3, 10)),
+    ('1E+5', numeric(1, 1, 0x0000, 0, 10)),
+    ('-123.4500', numeric(2, 0, 0x4000, 4, 123, 4500)),
+    ('12345678.9', numeric(3, 1, 0x0000, 1, 1234, 5678, 9000)),
+    (Decimal('0.00012'), numeric(2, -1, 0x0000, 5, 1, 2000)),
+    (1.1, numeric(2, 0, 0x0000, 1, 1, 1000)),
+    (10, numeric(1, 0, 0x0000, 0, 10)),
+    ('NaN', numeric(0, 0, 0xC000, 0)),
+])
+def test_pack_numeric(value, expected):
+    assert pack_numeric(value) == expected
+
+
+def test_pack_numeric_rejects_infinity():
+    with pytest.raises(ValueError):
+        pack_numeric('Infinity')
+
+
+def test_pack_timestamp():
+    expected = int((datetime(2021, 3, 4, 5, 6, 7, 123456) - datetime(2000, 1, 1)).total_seconds() * 1000000)
+    assert pack_timestamp('2021-03-04T05:06:07.123456Z') == struct.pack('>q', expected)
+    # Like Postgres for timestamp without time zone, the offset is ignored
+    assert pack_timestamp('2021-03-04T05:06:07.123456+02:00') == struct.pack('>q', expected)
+    assert pack_timestamp('1999-12-31T23:59:59') == struct.pack('>q', -1000000)
+
+
+def test_pack_boolean():
+    assert pack_boolean(True) == b'\x01'
+    assert pack_boolean('yes') == b'\x01'
+    assert pack_boolean('False') == b'\x00'
+    assert pack_boolean(0) == b'\x00'
+    with pytest.raises(ValueError):
+        pack_boolean('maybe')
+    with pytest.raises(ValueError):
+        pack_boolean(2)
+
+
+def test_pack_bigint():
+    assert pack_bigint(42) == struct.pack('>q', 42)
+    assert pack_bigint('42') == struct.pack('>q', 42)
+    assert pack_bigint(3.0) == struct.pack('>q', 3)
+    with pytest.raises(ValueError):
+        pack_bigint('1.5')
+    with pytest.raises(ValueError):
+        pack_bigint(1.5)
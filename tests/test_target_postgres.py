@@ -0,0 +1,177 @@
+import io
+import json
+import math
+import time
+
+import fastjsonschema
+import pytest
+
+import target_postgres
+from target_postgres import (DEFAULT_MAX_BATCH_SIZE, BatchSizeTuner, StreamLoader, compile_validator, iter_lines,
+                             json_loads)
+from target_postgres.db_sync import DbSync
+
+requires_orjson = pytest.mark.skipif(target_postgres.orjson is None, reason='orjson is not installed')
+
+
+def test_compile_validator_reads_draft_4_exclusive_bounds():
+    # As emitted by tap-postgres for numeric columns
+    schema = {
+        'type': 'object',
+        'properties': {
+            'amount': {
+                'type': ['null', 'number'],
+                'exclusiveMaximum': True,
+                'maximum': 1e38,
+                'exclusiveMinimum': True,
+                'minimum': -1e38,
+                'multipleOf': 0.01,
+            },
+        },
+    }
+    validate = compile_validator(schema)
+    for amount in (12.34, 0.3, None):
+        validate({'amount': amount})
+    with pytest.raises(fastjsonschema.JsonSchemaException):
+        validate({'amount': 1e38})
+    assert '$schema' not in schema
+
+
+def test_compile_validator_ignores_formats():
+    validate = compile_validator({'type': 'object', 'properties': {'t': {'type': 'string', 'format': 'date-time'}}})
+    validate({'t': '2021-01-01 10:00:00'})
+
+
+def tune(tuner, seconds_per_batch):
+    '''Feed `tuner` full batches taking `seconds_per_batch(batch_size)` each.'''
+    tuner.flushed(tuner.batch_size)
+    while tuner.tuning:
+        tuner.observe(tuner.batch_size, seconds_per_batch(tuner.batch_size))
+    return tuner.batch_size
+
+
+def test_batch_size_tuner_keeps_batch_size_without_tuning():
+    tuner = BatchSizeTuner(5000000, DEFAULT_MAX_BATCH_SIZE, False)
+    assert tuner.batch_size == 5000000
+    tuner.flushed(5000000)
+    tuner.flushed(5000000)
+    assert tuner.batch_size == 5000000
+
+
+def test_batch_size_tuner_doubles_and_settles_back():
+    # Batches take a second up to 40000 rows, so throughput stops improving past that
+    assert tune(BatchSizeTuner(10000, 1000000, True), lambda rows: rows / min(rows, 40000)) == 40000
+
+
+def test_batch_size_tuner_stops_at_max():
+    tuner = BatchSizeTuner(10000, 50000, True)
+    assert tune(tuner, lambda rows: 1) == 50000
+    assert not tuner.tuning
+
+
+def test_batch_size_tuner_only_counts_full_batches(monkeypatch):
+    clock = iter([0, 1, 2, 3])
+    monkeypatch.setattr(time, 'monotonic', lambda: next(clock))
+    tuner = BatchSizeTuner(100, 1000, True)
+    tuner.flushed(100)
+    tuner.flushed(10)
+    assert tuner.batch_size == 100
+    tuner.flushed(100)
+    assert tuner.batch_size == 200
+    assert tuner.rows_per_second == 100
+
+
+def read_lines(data, chunk_size):
+    return list(iter_lines(io.BytesIO(data), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1 << 20])
+def test_iter_lines(chunk_size):
+    # Lines spanning several chunks, ending in a newline
+    assert read_lines(b'{"a": 1}\n{"bb": 22}\n', chunk_size) == [b'{"a": 1}', b'{"bb": 22}']
+    # A last line without a newline
+    assert read_lines(b'first\nlast', chunk_size) == [b'first', b'last']
+    assert read_lines(b'', chunk_size) == []
+
+
+def test_iter_lines_joins_line_spanning_many_chunks():
+    line = bytes(range(32, 127)) * 100
+    assert read_lines(line + b'\n' + line, 10) == [line, line]
+
+
+def test_iter_lines_with_chunks_of_newlines():
+    # Chunks made only of newlines end the pending line and yield the empty lines between them
+    assert read_lines(b'ab\n\n\ncd', 2) == [b'ab', b'', b'', b'cd']
+    assert read_lines(b'\n\n\n\n', 2) == [b'', b'', b'', b'']
+
+
+@pytest.mark.parametrize('line', [b'{"id": 12345678901234567890123}', '{"id": -9223372036854775809}'])
+def test_json_loads_keeps_long_integers_exact(line):
+    assert json_loads(line) == json.loads(line)
+    assert isinstance(json_loads(line)['id'], int)
+
+
+@requires_orjson
+def test_json_loads_parses_with_orjson(monkeypatch):
+    monkeypatch.setattr(json, 'loads', None)
+    assert json_loads(b'{"type": "RECORD", "record": {"id": 1, "v": 1.5}}') == \
+        {'type': 'RECORD', 'record': {'id': 1, 'v': 1.5}}
+
+
+@requires_orjson
+def test_json_loads_falls_back_to_json():
+    assert math.isnan(json_loads(b'{"v": NaN}')['v'])
+    assert json_loads(b'{"v": Infinity}')['v'] == math.inf
+    assert json_loads(b'{"v": 1e400}')['v'] == math.inf
+
+
+def test_json_loads_rejects_invalid_json():
+    with pytest.raises(json.JSONDecodeError):
+        json_loads(b'{"type": ')
+
+
+class CapturingSync(DbSync):
+    '''DbSync keeping what COPY would read instead of loading it.'''
+
+    def load_csv(self, file, before_merge=None):
+        self.copied = file.read()
+        if before_merge is not None:
+            before_merge()
+
+
+def copy_csv(properties, records):
+    sync = CapturingSync({'schema': 'test'}, {'stream': 'test', 'schema': {'properties': properties}})
+    loader = StreamLoader(sync)
+    for record in records:
+        loader.write(sync.record_to_copy_row(record))
+    loader.finish()
+    return sync.copied
+
+
+def test_csv_copy_rows():
+    properties = {
+        'id': {'type': 'integer'},
+        'name': {'type': ['null', 'string']},
+        'active': {'type': ['null', 'boolean']},
+        'amount': {'type': ['null', 'number']},
+    }
+    assert copy_csv(properties, [
+        {'id': 1, 'name': 'plain', 'active': True, 'amount': 1.5},
+        {'id': 2, 'name': None, 'active': None, 'amount': None},
+        {'id': 3, 'name': '', 'active': False},
+        {'id': 4, 'name': 'say "hi"\nand, bye', 'active': False, 'amount': 0},
+        {'id': 5, 'name': 'back\\slash'},
+    ]) == (
+        # Columns come in the sorted order of flatten_schema: active, amount, id, name
+        b'True,1.5,1,"plain"\n'
+        # NULL is an unquoted empty field, an empty string a quoted one
+        b',,2,\n'
+        b'False,,3,""\n'
+        b'False,0,4,"say ""hi""\nand, bye"\n'
+        b',,5,"back\\slash"\n'
+    )
+
+
+def test_csv_copy_single_column_rows():
+    assert copy_csv({'name': {'type': ['null', 'string']}}, [{'name': None}, {'name': ''}, {'name': 'a'}]) == \
+        b'\n""\n"a"\n'